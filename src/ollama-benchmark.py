@@ -5,8 +5,11 @@
 ###   Download and test a list of models defined in the script. LLMs were 
 ###     selected based on their size: PaperQA2 recommends using models with 7B 
 ####    parameters or greater, but the models also must fit within memory (48 GB).
-###   Measure runtime and speed (tokens per second) on a single query.
-###   Save the results to `results/ollama_benchmark.csv`.
+###   Measure runtime and speed (tokens per second) on a single query, once
+###     with a cold model and then repeatedly with the model kept loaded.
+###   Save the results to `results/ollama_benchmark.csv`. Each run is also
+###     saved as it completes, so an interrupted benchmark resumes where it
+###     stopped.
 ### After running the script, review the benchmarking results in the CSV file 
 ### to exclude models that are too slow for practical use.
 ################################################################################
@@ -15,13 +18,26 @@
 ### Import packages
 ################################################################################
 
+import csv
+import numpy as np
+import orjson
 import os
-import pandas as pd
 import requests
 import requests.exceptions
+from requests.adapters import HTTPAdapter
 import subprocess
 import time
 from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+# Connect and read timeouts (in seconds) for requests to the Ollama server
+REQUEST_TIMEOUT = (10, 600)
+
+# Columns of the checkpoint file, which stores the raw result of each run
+CHECKPOINT_FIELDS = [
+    "Model", "Parameters", "Run", "Iteration", "Answer", "total_duration",
+    "load_duration", "prompt_eval_duration", "eval_count", "eval_duration"
+]
 
 ################################################################################
 ### Functions
@@ -32,14 +48,14 @@ def create_logs_directory():
     os.makedirs("logs", exist_ok=True)
     print("Logs directory created.")
 
-def start_ollama_server():
+def start_ollama_server(stdout_log, stderr_log):
     """Start the Ollama server."""
     print("Starting Ollama server...")
     
     process = subprocess.Popen(
         ["ollama", "serve"],
-        stdout=open("logs/stdout.log", "a"),
-        stderr=open("logs/stderr.log", "a")
+        stdout=stdout_log,
+        stderr=stderr_log
     )
     time.sleep(5)  # Give the server time to start
     return process
@@ -50,65 +66,198 @@ def stop_ollama_server(process):
     process.terminate()
     process.wait()
 
-def benchmark_model(model, prompt, ollama_server_url):
-    """Benchmark a single model."""
-
-    model_name = model["name"]
-    model_parameters = model["parameters"]
-    full_model_name = f"{model_name}:{model_parameters}"
+def create_session():
+    """Create an HTTP session that reuses connections to the Ollama server."""
+    session = requests.Session()
 
-    # Download the model
-    print(f"Downloading model {full_model_name} ...")
-    subprocess.run(["ollama", "pull", full_model_name],
-                    stdout=open("logs/stdout.log", "a"),
-                    stderr=open("logs/stderr.log", "a")
+    # Retry connection failures and gateway errors with exponential backoff, but
+    # not read timeouts, which would re-run a generation that is already too slow
+    retry = Retry(
+        total=3,
+        read=False,
+        backoff_factor=2,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=["GET", "POST"],
     )
+    session.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=retry))
+    session.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip"})
+    return session
 
-    # Run the model with the question
-    print(f"Running model {full_model_name} ...")
+def get_installed_models(session, ollama_server_url):
+    """
+    Return the names of the models already downloaded to the Ollama server, or
+    no models if the server cannot list them.
+    """
     try:
-        response = requests.post(
+        response = session.get(f"{ollama_server_url}/api/tags", timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"Could not list downloaded models: {e}")
+        return set()
+    return {m["name"] for m in response.json().get("models", [])}
+
+def run_prompt(session, full_model_name, prompt, ollama_server_url):
+    """Send the prompt to a single model and record the answer and raw timings."""
+    timings = {
+        "total_duration": 0,
+        "load_duration": 0,
+        "prompt_eval_duration": 0,
+        "eval_count": 0,
+        "eval_duration": 0
+    }
+
+    try:
+        # keep_alive=-1 keeps the model loaded between repeats
+        response = session.post(
             f"{ollama_server_url}/api/generate",
-            json={"model": full_model_name, "prompt": prompt, "stream": False},
+            json={"model": full_model_name, "prompt": prompt, "stream": False, "keep_alive": -1},
+            timeout=REQUEST_TIMEOUT,
         )
 
-        # Record the answer and runtime
+        # Record the answer and timings (durations are in nanoseconds)
         if response.status_code == 200:
-            answer = response.json().get("response", "No response")
-            runtime = response.json().get("total_duration", 0) / 10**9
-            speed = (response.json().get("eval_count", 0) / response.json().get("eval_duration", 0)) * 10**9
+            payload = orjson.loads(response.content)
+            answer = payload.get("response", "No response")
+            timings = {key: payload.get(key, 0) for key in timings}
         else:
             answer = "Error"
-            runtime = 0
-            speed = 0
 
     except requests.exceptions.Timeout:
-        print(f"Model {full_model_name} timed out after 60 seconds.")
+        print(f"Model {full_model_name} timed out after {REQUEST_TIMEOUT[1]} seconds.")
         answer = "Timeout"
-        runtime = 0
-        speed = 0
 
-    # Stop the model
+    except requests.exceptions.RequestException as e:
+        print(f"Model {full_model_name} failed: {e}")
+        answer = "Error"
+
+    return {"Answer": answer, **timings}
+
+def benchmark_model(session, model, prompt, ollama_server_url, n_warm):
+    """
+    Benchmark a single model: one cold query, which includes loading the model,
+    followed by n_warm warm queries to the loaded model. Returns no results if
+    the model cannot be downloaded.
+    """
+
+    model_name = model["name"]
+    model_parameters = model["parameters"]
+    full_model_name = f"{model_name}:{model_parameters}"
+
+    # Download the model, unless the server already has it
+    if full_model_name in get_installed_models(session, ollama_server_url):
+        print(f"Model {full_model_name} already downloaded.")
+    else:
+        print(f"Downloading model {full_model_name} ...")
+        try:
+            response = session.post(
+                f"{ollama_server_url}/api/pull",
+                json={"model": full_model_name, "stream": False},
+                timeout=(REQUEST_TIMEOUT[0], None),  # Large models take hours to download
+            )
+            error = None if response.status_code == 200 else response.text
+        except requests.exceptions.RequestException as e:
+            error = e
+        if error is not None:
+            print(f"Failed to download model {full_model_name}, skipping it: {error}")
+            return []
+
+    # Run the model with the question, starting from a cold model
+    print(f"Running model {full_model_name} (cold) ...")
+    cold = run_prompt(session, full_model_name, prompt, ollama_server_url)
+
+    # Run the warm queries one after another, so that each one measures the
+    # speed of a single request rather than decoding shared with other requests
+    print(f"Running model {full_model_name} (warm) ...")
+    warm = [run_prompt(session, full_model_name, prompt, ollama_server_url) for _ in range(n_warm)]
+
+    # Stop the model by unloading it immediately (keep_alive=0)
     print(f"Stopping model {full_model_name} ...")
-    subprocess.run(["ollama", "stop", full_model_name],
-                    stdout=open("logs/stdout.log", "a"),
-                    stderr=open("logs/stderr.log", "a")
-    )
+    try:
+        session.post(
+            f"{ollama_server_url}/api/generate",
+            json={"model": full_model_name, "keep_alive": 0},
+            timeout=REQUEST_TIMEOUT,
+        )
+    except requests.exceptions.RequestException as e:
+        print(f"Warning: could not stop model {full_model_name}: {e}")
     time.sleep(5)  # Give the server time to stop
 
-    return {
-        "Model": model_name,
-        "Parameters": model_parameters,
-        "Answer": answer,
-        "Runtime (s)": runtime,
-        "Speed (tokens/s)": speed
-    }
+    outputs = [("cold", cold)] + [("warm", output) for output in warm]
+    return [
+        {"Model": model_name, "Parameters": model_parameters, "Run": run, "Iteration": i, **output}
+        for i, (run, output) in enumerate(outputs)
+    ]
+
+def load_checkpoint(checkpoint_file):
+    """
+    Load the results of runs saved by a previous, interrupted benchmark. Rows that
+    cannot be parsed, such as a row cut off when the benchmark was killed, are skipped,
+    as are failed runs, so that they are measured again.
+    """
+    if not os.path.exists(checkpoint_file):
+        return []
+
+    # Restore the iteration and raw timings, which are stored as text
+    text_fields = ["Model", "Parameters", "Run", "Answer"]
+    results = []
+    skipped = 0
+    failed = 0
+    with open(checkpoint_file, newline="") as file:
+        try:
+            for row in csv.DictReader(file):
+                try:
+                    if any(row[key] is None for key in text_fields):
+                        raise ValueError("missing field")
+                    if row["Answer"] == "Error":
+                        failed += 1
+                        continue
+                    results.append({
+                        key: row[key] if key in text_fields else int(row[key])
+                        for key in CHECKPOINT_FIELDS
+                    })
+                except (KeyError, TypeError, ValueError):
+                    skipped += 1
+        except csv.Error:
+            skipped += 1
+
+    if skipped:
+        print(f"Skipped {skipped} unreadable rows in '{checkpoint_file}'.")
+    if failed:
+        print(f"Dropped {failed} failed runs from '{checkpoint_file}' to run them again.")
+    return results
 
 def save_results(results, output_file):
     """Save benchmarking results to a CSV file."""
-    benchmark_results = pd.DataFrame(results)
+    def column(key):
+        return np.array([result[key] for result in results], dtype=float)
+
+    # Convert the raw timings to seconds and tokens per second. Failed runs have
+    # zero durations, which are reported as zero speed rather than dividing by zero.
+    eval_count = column("eval_count")
+    eval_duration = column("eval_duration")
+    load_duration = column("load_duration")
+    derived = {
+        "Runtime (s)": column("total_duration") / 1e9,
+        "Load (s)": load_duration / 1e9,
+        "TTFT (s)": (load_duration + column("prompt_eval_duration")) / 1e9,
+        "Speed (tokens/s)": np.divide(
+            eval_count, eval_duration, out=np.zeros_like(eval_count), where=eval_duration > 0
+        ) * 1e9,
+    }
+    derived_rows = zip(*(values.tolist() for values in derived.values()))
+
     os.makedirs("results", exist_ok=True)
-    benchmark_results.to_csv(output_file, index=False)
+    with open(output_file, "w", newline="", buffering=1 << 20) as file:
+        writer = csv.DictWriter(
+            file,
+            fieldnames=["Model", "Parameters", "Run", "Iteration", "Answer", *derived],
+            extrasaction="ignore",
+        )
+        writer.writeheader()
+        writer.writerows(
+            {**result, **dict(zip(derived, values))}
+            for result, values in zip(results, derived_rows)
+        )
     print(f"Benchmarking complete. Results saved to '{output_file}'.")
 
 
@@ -142,29 +291,72 @@ def main():
     # Define the question to ask
     prompt = "In molecular biology, what are the four canonical bases of DNA?"
 
+    # Define the number of warm queries to run after each model's cold query
+    n_warm = 2
+
+    # Resume from the runs saved by a previous, interrupted benchmark
+    checkpoint_file = "results/ollama_benchmark_runs.csv"
+    benchmark_results_list = load_checkpoint(checkpoint_file)
+    completed = {(r["Model"], r["Parameters"], r["Iteration"]) for r in benchmark_results_list}
+
+    # Rewrite the checkpoint with only the readable runs (via a temporary file, so
+    # that the saved runs survive a crash during the rewrite)
+    os.makedirs("results", exist_ok=True)
+    with open(f"{checkpoint_file}.tmp", "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=CHECKPOINT_FIELDS)
+        writer.writeheader()
+        writer.writerows(benchmark_results_list)
+    os.replace(f"{checkpoint_file}.tmp", checkpoint_file)
+
+    # Save each new run to the checkpoint as soon as it completes
+    checkpoint = open(checkpoint_file, "a", newline="", buffering=1 << 16)
+    checkpoint_writer = csv.DictWriter(checkpoint, fieldnames=CHECKPOINT_FIELDS)
+
     # Create the logs directory
     create_logs_directory()
 
-    # Start the Ollama server
-    ollama_process = start_ollama_server()
-    ollama_server_url = "http://localhost:11434"  # Default Ollama server address
+    # Open the log files for the Ollama server
+    stdout_log = open("logs/stdout.log", "a")
+    stderr_log = open("logs/stderr.log", "a")
 
-    # Create a list to store benchmarking outputs
-    benchmark_results_list = []
+    # Share one HTTP session across all requests to the server
+    session = create_session()
+    ollama_server_url = "http://localhost:11434"  # Default Ollama server address
+    ollama_process = None
 
     try:
+        # Start the Ollama server
+        ollama_process = start_ollama_server(stdout_log, stderr_log)
+
         # Use tqdm to display progress
         for model in tqdm(models, desc="Benchmarking Models"):
-            for i in range(3):
-                result = benchmark_model(model, prompt, ollama_server_url)
-                benchmark_results_list.append(result)
-                time.sleep(5)  # Sleep for 5 seconds between queries
+            if all((model["name"], model["parameters"], i) in completed for i in range(n_warm + 1)):
+                print(f"Model {model['name']}:{model['parameters']} already benchmarked.")
+                continue
+
+            results = benchmark_model(session, model, prompt, ollama_server_url, n_warm)
+            for result in results:
+                if (result["Model"], result["Parameters"], result["Iteration"]) not in completed:
+                    # Failed runs are reported but not checkpointed, so a resumed
+                    # benchmark measures them again
+                    if result["Answer"] != "Error":
+                        checkpoint_writer.writerow(result)
+                    benchmark_results_list.append(result)
+            checkpoint.flush()
+            time.sleep(5)  # Sleep for 5 seconds between models
     finally:
-        # Shut down the Ollama server
-        stop_ollama_server(ollama_process)
+        # Close the checkpoint and HTTP session, shut down the Ollama server, and close the logs
+        checkpoint.close()
+        session.close()
+        if ollama_process is not None:
+            stop_ollama_server(ollama_process)
+        stdout_log.close()
+        stderr_log.close()
 
-    # Save the benchmarking results to a CSV file
+    # Save the benchmarking results to a CSV file, and remove the checkpoint so
+    # that the next benchmark starts from scratch
     save_results(benchmark_results_list, "results/ollama_benchmark.csv")
+    os.remove(checkpoint_file)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
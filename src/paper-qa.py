@@ -9,14 +9,17 @@
 
 import argparse
 import asyncio
+import collections
 import csv
+import hashlib
 import os
-import pandas as pd
+import pickle
+import threading
 import yaml
-from paperqa import Settings, ask
-from paperqa.agents import build_index
-from paperqa.settings import AgentSettings, AnswerSettings, IndexSettings, ParsingSettings
-from pyzotero import zotero
+from concurrent.futures import ThreadPoolExecutor
+
+# paperqa and pyzotero take seconds to import, so they are imported by the
+# functions that use them and only the selected mode pays for them
 
 ################################################################################
 ### Functions
@@ -35,6 +38,64 @@ def load_config(config_path):
     with open(config_path, "r") as file:
         return yaml.safe_load(file)
 
+def get_embedding_settings(config):
+    """
+    Builds the PaperQA embedding settings from the configuration.
+
+    Args:
+        config (dict): Parsed configuration as a dictionary.
+
+    Returns:
+        dict: Keyword arguments for the embedding fields of PaperQA's Settings.
+
+    Description:
+        Ollama embedding models (e.g., 'ollama/mxbai-embed-large') are sent to
+        the Ollama server's /api/embed endpoint, which embeds each batch of
+        document chunks in a single request.
+    """
+    embedding = config.get("paperqa_embedding")
+    if not embedding:
+        return {}
+    if not embedding.startswith("ollama/"):
+        return {"embedding": embedding}
+    api_base = config.get("ollama_api_base", "http://localhost:11434")
+    return {"embedding": embedding, "embedding_config": {"kwargs": {"api_base": api_base}}}
+
+def get_paperqa_settings(config, papers_dir, manifest_path, index_dir):
+    """
+    Builds the PaperQA settings used for indexing and querying.
+
+    Args:
+        config (dict): Parsed configuration as a dictionary.
+        papers_dir (str): Directory of downloaded papers.
+        manifest_path (str): Path to the manifest file.
+        index_dir (str): Directory where the index is stored.
+
+    Returns:
+        Settings: PaperQA settings.
+    """
+    from paperqa import Settings
+    from paperqa.settings import AgentSettings, AnswerSettings, IndexSettings, ParsingSettings
+
+    return Settings(
+            llm_config={"rate_limit": {"gpt-4o-2024-11-20": "30000 per 1 minute"}},
+            summary_llm_config={"rate_limit": {"gpt-4o-2024-11-20": "30000 per 1 minute"}},
+            agent=AgentSettings(
+                index=IndexSettings(
+                    paper_directory=papers_dir,
+                    manifest_file=manifest_path,
+                    index_directory=index_dir,
+                )
+            ),
+            parsing=ParsingSettings(
+                use_doc_details=False
+            ),
+            answer=AnswerSettings(
+                answer_length="Around 1000 words",
+            ),
+            **get_embedding_settings(config)
+        )
+
 def get_zotero_items(library_id, api_key, library_type):
     """
     Retrieves all items from a Zotero library.
@@ -47,14 +108,16 @@ def get_zotero_items(library_id, api_key, library_type):
     Returns:
         tuple: A tuple containing the list of items and the Zotero client instance.
     """
+    from pyzotero import zotero
+
     zot = zotero.Zotero(library_id, library_type, api_key)
     items = zot.everything(zot.top())
     return items, zot
 
 def extract_metadata(items, zot, papers_dir):
     """
-    Extracts metadata from Zotero items, downloads associated files, and updates
-    the local metadata to reflect changes in the Zotero library.
+    Extracts metadata from Zotero items, finds associated files to download, and
+    updates the local metadata to reflect changes in the Zotero library.
 
     Args:
         items (list): List of Zotero items.
@@ -62,11 +125,12 @@ def extract_metadata(items, zot, papers_dir):
         papers_dir (str): Directory to store downloaded papers.
 
     Returns:
-        list: Metadata for each item, including file location, DOI, and title.
+        tuple: A tuple containing the metadata for each item (file location, DOI,
+        and title) and the list of (attachment key, file location) downloads.
 
     Description:
-        - Downloads attachments for items in the Zotero library if they do not
-          already exist locally.
+        - Collects attachments for items in the Zotero library that do not
+          already exist locally, to be downloaded with download_attachments.
         - Tracks the current files in Zotero and compares them with the existing
           files in the local directory.
         - Removes files from the local directory that are no longer present in
@@ -75,6 +139,7 @@ def extract_metadata(items, zot, papers_dir):
           each item in the Zotero library.
     """
     metadata = []
+    downloads = []
     existing_files = set(os.listdir(papers_dir)) if os.path.exists(papers_dir) else set()
 
     if not os.path.exists(papers_dir):
@@ -82,33 +147,43 @@ def extract_metadata(items, zot, papers_dir):
 
     current_files = set()  # Track files currently in Zotero
 
+    # Retrieve all file attachments at once and group them by parent item,
+    # rather than requesting the children of each item separately
+    attachments_by_parent = collections.defaultdict(list)
+    for att in zot.everything(zot.items(itemType='attachment')):
+        if 'filename' in att['data']:
+            attachments_by_parent[att['data'].get('parentItem')].append(att)
+
     for item in items:
-        if 'data' in item:
-            doi = item['data'].get('DOI', 'N/A')
-            title = item['data'].get('title', 'N/A')
+        # Skip items without files (e.g., notes and references without a PDF)
+        if 'data' not in item or item['key'] not in attachments_by_parent:
+            continue
+
+        doi = item['data'].get('DOI', 'N/A')
+        title = item['data'].get('title', 'N/A')
 
-            # Find attachment
-            attachments = zot.children(item['key'])
-            for att in attachments:
-                if 'filename' in att['data']:
-                    file_name = att['data']['filename']
-                    file_location = os.path.join(papers_dir, file_name)
-                    current_files.add(file_name)
+        # Find attachment
+        for att in attachments_by_parent[item['key']]:
+            file_name = att['data']['filename']
+            file_location = os.path.join(papers_dir, file_name)
+            current_files.add(file_name)
 
-                    # Download file if it doesn't exist
-                    if not os.path.exists(file_location):
-                        download_attachment(zot, att['key'], file_location)
+            # Download file if it doesn't exist
+            if file_name not in existing_files:
+                downloads.append((att['key'], file_location))
+                existing_files.add(file_name)
 
-                    metadata.append([file_location, doi, title])
+            metadata.append([file_location, doi, title])
 
     # Remove files that are no longer in Zotero
     files_to_remove = existing_files - current_files
     for file_name in files_to_remove:
-        file_path = os.path.join(papers_dir, file_name)
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        try:
+            os.unlink(os.path.join(papers_dir, file_name))
+        except FileNotFoundError:
+            pass
 
-    return metadata
+    return metadata, downloads
 
 def download_attachment(zot, attachment_key, file_location):
     """
@@ -122,24 +197,67 @@ def download_attachment(zot, attachment_key, file_location):
     Returns:
         None
     """
-    if not os.path.exists(file_location):
-        zot.dump(attachment_key, file_location)
+    zot.dump(attachment_key, file_location)
 
-def save_metadata_csv(metadata, csv_path="manifest.csv"):
+def download_attachments(downloads, library_id, api_key, library_type, max_workers=16):
+    """
+    Downloads attachments from Zotero in parallel.
+
+    Args:
+        downloads (list): List of (attachment key, file location) tuples.
+        library_id (str): Zotero library ID.
+        api_key (str): Zotero API key.
+        library_type (str): Type of Zotero library (e.g., 'user' or 'group').
+        max_workers (int): Number of concurrent downloads (default: 16).
+
+    Returns:
+        list: The (attachment key, file location) tuples that failed to download.
+
+    Description:
+        The Zotero client keeps per-request state, so each worker thread
+        creates and reuses its own client instance. A failed download (e.g. a
+        rate limit or a missing file) is reported and its partial file removed,
+        so that the remaining downloads continue and it is retried next time.
+    """
+    from pyzotero import zotero
+
+    local = threading.local()
+
+    def download(attachment):
+        try:
+            if not hasattr(local, "zot"):
+                local.zot = zotero.Zotero(library_id, library_type, api_key)
+            download_attachment(local.zot, *attachment)
+            return True
+        except Exception as e:
+            print(f"Error: Download failed: {attachment[0]}\n{e!r}")
+            if os.path.exists(attachment[1]):
+                os.remove(attachment[1])
+            return False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        succeeded = list(executor.map(download, downloads))
+    return [attachment for attachment, ok in zip(downloads, succeeded) if not ok]
+
+def save_metadata_csv(metadata, csv_path="manifest.csv", fsync=False):
     """
     Saves metadata to a CSV file.
 
     Args:
         metadata (list): List of metadata entries (for each file: file location, DOI, and title)
         csv_path (str): Path to the CSV file (default: "manifest.csv").
+        fsync (bool): Whether to sync the file to disk before closing it (default: False).
 
     Returns:
         None
     """
-    with open(csv_path, mode='w', newline='') as file:
+    with open(csv_path, mode='w', newline='', buffering=1 << 20) as file:
         writer = csv.writer(file)
         writer.writerow(["file_location", "doi", "title"])
         writer.writerows(metadata)
+        if fsync:
+            file.flush()
+            os.fsync(file.fileno())
 
 def index_library(settings):
     """
@@ -151,23 +269,127 @@ def index_library(settings):
     Returns:
         None
     """
+    from paperqa.agents import build_index
+
     built_index = build_index(settings = settings)
 
-def query_library(settings, query):
+def get_index_state(settings):
     """
-    Queries the indexed documents using PaperQA, using the provided settings and query.
+    Summarizes the current state of the PaperQA paper index and manifest.
 
     Args:
         settings (Settings): PaperQA settings for querying.
-        query (str): Query string to search the indexed documents.
 
     Returns:
-        None
+        str: SHA-256 hash of the path, size, and modification time of every file in
+        the paper index and of the manifest file.
+
+    Description:
+        Only the paper index (the subdirectory of the index directory named after
+        the settings) is included. PaperQA saves every answer to a separate
+        'answers' index in the same directory, which would otherwise change the
+        state after each query. Lock files are skipped for the same reason.
     """
-    answer_response = ask(
-        query,
-        settings = settings
+    index_settings = settings.agent.index
+    paper_index_dir = os.path.join(
+        index_settings.index_directory, index_settings.name or settings.get_index_name()
     )
+    paths = [str(index_settings.manifest_file)] if index_settings.manifest_file else []
+    for root, _, files in os.walk(paper_index_dir):
+        paths.extend(
+            os.path.join(root, file_name) for file_name in files if not file_name.endswith(".lock")
+        )
+
+    state = hashlib.sha256()
+    for path in sorted(paths):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        state.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    return state.hexdigest()
+
+def get_query_cache_path(settings, query, cache_dir, index_state):
+    """
+    Returns the path of the cached answer for a query.
+
+    Args:
+        settings (Settings): PaperQA settings for querying.
+        query (str): Query string to search the indexed documents.
+        cache_dir (str): Directory of cached answers.
+        index_state (str): State of the index, from get_index_state.
+
+    Returns:
+        str: Path to the cached answer file.
+
+    Description:
+        The file name is a SHA-256 hash of the query, the PaperQA settings, and
+        the index state, so changing any of them (including downloading or
+        re-indexing papers) results in a new answer.
+    """
+    key = hashlib.sha256(
+        (query + settings.model_dump_json() + index_state).encode("utf-8")
+    ).hexdigest()
+    return os.path.join(cache_dir, f"{key}.pkl")
+
+def query_library(settings, queries, cache_dir=None, read_cache=True):
+    """
+    Queries the indexed documents using PaperQA, using the provided settings and queries.
+    Queries are run concurrently, and answers are cached on disk so that a repeated
+    query returns the cached answer.
+
+    Args:
+        settings (Settings): PaperQA settings for querying.
+        queries (list): Query strings to search the indexed documents.
+        cache_dir (str): Directory of cached answers, or None to disable the cache (default: None).
+        read_cache (bool): Whether to return cached answers; if False, every query is
+            asked again and its cached answer is replaced (default: True).
+
+    Returns:
+        list: PaperQA's response (AnswerResponse) to each query, or None for a query
+        that failed.
+    """
+    from paperqa.agents import configure_cli_logging
+    from paperqa.agents.main import agent_query
+
+    index_state = get_index_state(settings) if cache_dir else None
+    cache_paths = [
+        get_query_cache_path(settings, query, cache_dir, index_state) if cache_dir else None
+        for query in queries
+    ]
+
+    # Load the cached answers
+    answer_responses = [None] * len(queries)
+    for i, cache_path in enumerate(cache_paths):
+        if read_cache and cache_path and os.path.exists(cache_path):
+            with open(cache_path, "rb") as file:
+                answer_responses[i] = pickle.load(file)
+            print(f"Found cached answer for: {queries[i]}")
+
+    # Run a query and cache its answer as soon as it completes
+    async def run_query(i):
+        answer_response = await agent_query(queries[i], settings, agent_type=settings.agent.agent_type)
+        if cache_paths[i]:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_paths[i], "wb") as file:
+                pickle.dump(answer_response, file)
+        return answer_response
+
+    # Run the remaining queries concurrently in a single event loop, so that a
+    # failed query does not discard the answers to the others
+    async def run_all(pending):
+        return await asyncio.gather(*[run_query(i) for i in pending], return_exceptions=True)
+
+    pending = [i for i, answer_response in enumerate(answer_responses) if answer_response is None]
+    if pending:
+        configure_cli_logging(settings)
+        for i, answer_response in zip(pending, asyncio.run(run_all(pending))):
+            if isinstance(answer_response, Exception):
+                print(f"Error: Query failed: {queries[i]}\n{answer_response!r}")
+            else:
+                answer_responses[i] = answer_response
+
+    return answer_responses
 
 ################################################################################
 ### Main function
@@ -178,6 +400,8 @@ def main():
     parser.add_argument("mode", choices=["download", "index", "query"], help="Mode to run the script in: 'download', 'index', or 'query'")
     parser.add_argument("--config", default="config/paper-qa.yml", help="Path to the configuration file (default: config/config.yml)")
     parser.add_argument("--query", help = "Query to ask the model")
+    parser.add_argument("--queries-file", help="File of queries to ask the model, one per line")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore cached answers, query the model again, and update the cache")
     args = parser.parse_args()
 
     # Load configuration
@@ -195,47 +419,50 @@ def main():
     INDEX_DIR = config["paperqa_index_dir"]
     PAPERS_DIR = config["paperqa_papers_dir"]
     MANIFEST_PATH = config["paperqa_manifest_path"]
-
-    # Define the settings for PaperQA
-    settings = Settings(
-            llm_config={"rate_limit": {"gpt-4o-2024-11-20": "30000 per 1 minute"}},
-            summary_llm_config={"rate_limit": {"gpt-4o-2024-11-20": "30000 per 1 minute"}},
-            agent=AgentSettings(
-                index=IndexSettings(
-                    paper_directory=PAPERS_DIR,
-                    manifest_file=MANIFEST_PATH,
-                    index_directory=INDEX_DIR,
-                )
-            ),
-            parsing=ParsingSettings(
-                use_doc_details=False
-            ),
-            answer=AnswerSettings(
-                answer_length="Around 1000 words",
-            )
-        )
+    QUERY_CACHE_DIR = config.get("paperqa_query_cache_dir", "results/query_cache")
 
     if args.mode == "download":
         print("Retrieving Zotero items...")
         items, zot = get_zotero_items(LIBRARY_ID, API_KEY, LIBRARY_TYPE)
 
         print("Extracting metadata...")
-        metadata = extract_metadata(items, zot, PAPERS_DIR)
+        metadata, downloads = extract_metadata(items, zot, PAPERS_DIR)
+
+        print(f"Downloading {len(downloads)} attachments...")
+        failed = download_attachments(downloads, LIBRARY_ID, API_KEY, LIBRARY_TYPE)
+        if failed:
+            # Leave failed attachments out of the manifest so they are downloaded next time
+            print(f"{len(failed)} attachments failed to download.")
+            failed_files = {file_location for _, file_location in failed}
+            metadata = [row for row in metadata if row[0] not in failed_files]
 
         print("Saving metadata to manifest...")
         save_metadata_csv(metadata, csv_path=MANIFEST_PATH)
 
     elif args.mode == "index":
         print("Indexing documents with PaperQA...")
+        settings = get_paperqa_settings(config, PAPERS_DIR, MANIFEST_PATH, INDEX_DIR)
         index_library(settings)
 
     elif args.mode == "query":
-        if not args.query:
-            print("Error: You must provide a query using the --query argument in 'query' mode.")
+        if args.queries_file:
+            with open(args.queries_file, "r") as file:
+                queries = [line.strip() for line in file if line.strip()]
+        elif args.query:
+            queries = [args.query]
+        else:
+            print("Error: You must provide a query using the --query or --queries-file argument in 'query' mode.")
             return
 
-        print(f"Querying the indexed documents with: {args.query}")
-        query_library(settings, args.query)
+        print(f"Querying the indexed documents with {len(queries)} queries...")
+        settings = get_paperqa_settings(config, PAPERS_DIR, MANIFEST_PATH, INDEX_DIR)
+        answer_responses = query_library(
+            settings, queries, cache_dir=QUERY_CACHE_DIR, read_cache=not args.no_cache
+        )
+        for query, answer_response in zip(queries, answer_responses):
+            if answer_response is not None:
+                print(f"Query: {query}")
+                print(answer_response.session.formatted_answer)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file